@@ -28,11 +28,14 @@ _CN.LOFTR.MATCH_COARSE.THR = 0.2
 _CN.LOFTR.MATCH_COARSE.BORDER_RM = 2
 _CN.LOFTR.MATCH_COARSE.MATCH_TYPE = 'dual_softmax'  # options: ['dual_softmax, 'sinkhorn']
 _CN.LOFTR.MATCH_COARSE.DSMAX_TEMPERATURE = 0.1
+_CN.LOFTR.MATCH_COARSE.DSMAX_BF16 = False  # bf16 similarity / dual-softmax on CUDA (Ampere+), inference only
+_CN.LOFTR.MATCH_COARSE.DSMAX_COMPILE = False  # torch.compile the similarity / dual-softmax (torch>=2.0, TorchScript before)
 _CN.LOFTR.MATCH_COARSE.SKH_ITERS = 3
 _CN.LOFTR.MATCH_COARSE.SKH_INIT_BIN_SCORE = 1.0
 _CN.LOFTR.MATCH_COARSE.SKH_PREFILTER = False
 _CN.LOFTR.MATCH_COARSE.TRAIN_COARSE_PERCENT = 0.2  # training tricks: save GPU memory
 _CN.LOFTR.MATCH_COARSE.TRAIN_PAD_NUM_GT_MIN = 200  # training tricks: avoid DDP deadlock
+_CN.LOFTR.MATCH_COARSE.NUMBA_CPU = False  # numba mutual-nearest extraction for CPU inference (needs numba)
 _CN.LOFTR.MATCH_COARSE.SPARSE_SPVS = True
 
 # 4. LoFTR-fine module loftr_config
@@ -1,27 +1,225 @@
+import warnings
 from typing import Dict, Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops.einops import rearrange
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, only used to speed up CPU inference
+    njit = None
+
 
 # INF = 1e9
 
 
+def valid_hw(p_m):
+    """Height and width of the unpadded region of each padded mask
+
+    Args:
+        p_m (torch.Tensor): [N, H, W] padded mask
+    Returns:
+        hw_valid (torch.Tensor): [N, 2]
+    """
+    return torch.stack([p_m.sum(1).amax(-1), p_m.sum(-1).amax(-1)], -1)
+
+
 def compute_max_candidates(p_m0, p_m1):
     """Compute the max candidates of all pairs within a batch
     
     Args:
         p_m0, p_m1 (torch.Tensor): padded masks
     """
-    h0s, w0s = p_m0.sum(1).max(-1)[0], p_m0.sum(-1).max(-1)[0]
-    h1s, w1s = p_m1.sum(1).max(-1)[0], p_m1.sum(-1).max(-1)[0]
-    max_cand = torch.sum(
-        torch.min(torch.stack([h0s * w0s, h1s * w1s], -1), -1)[0])
+    max_cand = torch.sum(torch.min(valid_hw(p_m0).prod(-1), valid_hw(p_m1).prod(-1)))
     return max_cand
 
 
+def dual_softmax(sim_matrix, mask_c0: Optional[torch.Tensor] = None, mask_c1: Optional[torch.Tensor] = None):
+    """Dual-softmax confidence, i.e. softmax(sim, 1) * softmax(sim, 2)
+
+    Args:
+        sim_matrix (torch.Tensor): [N, L, S], masked in place
+        mask_c0 (torch.Tensor): [N, L] (optional)
+        mask_c1 (torch.Tensor): [N, S] (optional)
+    Returns:
+        conf_matrix (torch.Tensor): [N, L, S]
+    """
+    INF = 1e9
+    if mask_c0 is not None and mask_c1 is not None:
+        # broadcast the row / column masks instead of materializing their [N, L, S] outer product
+        sim_matrix.masked_fill_(~mask_c0[:, :, None], -INF)
+        sim_matrix.masked_fill_(~mask_c1[:, None, :], -INF)
+    conf_matrix = F.softmax(sim_matrix, 1)
+    if conf_matrix.requires_grad:
+        return conf_matrix * F.softmax(sim_matrix, 2)
+    # no graph to keep intact, so the product can be written into the first softmax
+    return conf_matrix.mul_(F.softmax(sim_matrix, 2))
+
+
+def coarse_confidence(feat_c0, feat_c1, mask_c0: Optional[torch.Tensor], mask_c1: Optional[torch.Tensor],
+                      temperature: float, sim_buf: Optional[torch.Tensor] = None):
+    """Similarity + dual-softmax, kept free of the data dict so it can be compiled
+
+    Args:
+        feat_c0 (torch.Tensor): [N, L, C]
+        feat_c1 (torch.Tensor): [N, S, C]
+        mask_c0 (torch.Tensor): [N, L] (optional)
+        mask_c1 (torch.Tensor): [N, S] (optional)
+        temperature (float)
+        sim_buf (torch.Tensor): [N, L, S] (optional), reused for the similarity, no autograd
+    Returns:
+        conf_matrix (torch.Tensor): [N, L, S]
+    """
+    # the 1/sqrt(C) normalization of both features and the temperature collapse into the GEMM's alpha
+    scale = 1. / (feat_c0.size(2) * temperature)
+    if sim_buf is None:
+        # beta=0 ignores the (broadcast) input entirely
+        sim_matrix = torch.baddbmm(feat_c0.new_zeros(1, 1, 1), feat_c0, feat_c1.transpose(1, 2),
+                                   beta=0., alpha=scale)
+    else:
+        sim_matrix = sim_buf.baddbmm_(feat_c0, feat_c1.transpose(1, 2), beta=0., alpha=scale)
+    return dual_softmax(sim_matrix, mask_c0, mask_c1)
+
+
+# compiled / scripted coarse_confidence, built on first use when DSMAX_COMPILE is set. Kept out of
+# CoarseMatching since neither can be pickled or deep-copied along with the model
+_coarse_confidence_impls = {}
+
+
+def get_coarse_confidence(use_compile: bool = False):
+    """Return the eager coarse_confidence, or when requested its torch.compile'd version
+    (TorchScript where torch.compile is unavailable)
+
+    The eager version is the default: none of its ops fuse under the torch 1.8 fuser, so scripting
+    it alone only adds warm-up and re-specialization whenever L / S change.
+    """
+    if not use_compile:
+        return coarse_confidence
+    mode = 'compile' if hasattr(torch, 'compile') else 'script'
+    if mode not in _coarse_confidence_impls:
+        if mode == 'compile':
+            # L and S follow each pair's aspect ratio, so let dynamo generalize over shapes.
+            # NOTE: no 'reduce-overhead', its CUDA graphs would recycle the conf_matrix
+            # returned by the first of the two matching passes in GeoFormer
+            _coarse_confidence_impls[mode] = torch.compile(coarse_confidence)
+        else:
+            _coarse_confidence_impls[mode] = torch.jit.script(coarse_confidence)
+    return _coarse_confidence_impls[mode]
+
+
+# bytes moved by a single strided read: a 32B sector on CUDA GPUs, a 64B cache line on CPU
+_STRIDED_READ_BYTES = {'cuda': 32, 'cpu': 64}
+
+
+def mutual_nearest(conf_matrix, thr: float):
+    """Thresholded mutual nearest neighbours of each row of conf_matrix
+
+    Everything past the dual-softmax is memory bound (a compare per loaded element). This makes
+    one full row max/argmax pass over [N, L, S], then reduces only the columns picked by rows
+    above `thr` (or all columns, unless only a small fraction of them is picked).
+    The candidates are returned with their keep flags rather than scattered back into an [N, L]
+    mask, so the caller needs no second nonzero (each one is a device -> host sync).
+
+    Args:
+        conf_matrix (torch.Tensor): [N, L, S]
+        thr (float)
+    Returns:
+        row_max (torch.Tensor): [N, L]
+        row_argmax (torch.Tensor): [N, L]
+        b_c, i_c (torch.Tensor): [M], rows above `thr`
+        keep (torch.Tensor): [M], True where row i's max is also the max of its argmax column j.
+            Compared by value, so ties (common in bf16) keep every tied row, like the baseline's
+            equality test
+    """
+    N, L, S = conf_matrix.shape
+    row_max, row_argmax = conf_matrix.max(dim=2)
+    b_c, i_c = (row_max > thr).nonzero(as_tuple=True)
+    if b_c.numel() == 0:
+        # torch<1.9 refuses amax over the empty [0, L] gather below
+        return row_max, row_argmax, b_c, i_c, b_c.new_empty(0, dtype=torch.bool)
+    j_c = row_argmax[b_c, i_c]
+    # memory traffic model (not benchmarked): the gather costs one strided read plus a write and
+    # reread of the [M, L] result per gathered element, against element_size() per element of
+    # [N, L, S] for the coalesced full column max. That is M < N * S / 10 in fp32 on CUDA.
+    # M is already known on the host, deduplicating the columns would cost another sync
+    elem = conf_matrix.element_size()
+    strided = _STRIDED_READ_BYTES.get(conf_matrix.device.type, _STRIDED_READ_BYTES['cpu'])
+    if b_c.numel() * (strided + 2 * elem) < N * S * elem:
+        col_max = conf_matrix[b_c, :, j_c].amax(1)
+    else:
+        col_max = conf_matrix.amax(1)[b_c, j_c]
+    return row_max, row_argmax, b_c, i_c, col_max == row_max[b_c, i_c]
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def mutual_nearest_cpu(conf, thr):
+        """numba counterpart of `mutual_nearest` with the same returns, torch's CPU argmax is slow
+
+        Makes two full passes over conf: one per row, then one over chunks of contiguous columns.
+
+        Args:
+            conf (np.ndarray): [N, L, S]
+            thr (float)
+        Returns:
+            row_max (np.ndarray): [N, L]
+            row_argmax (np.ndarray): [N, L], int64
+            b_c, i_c (np.ndarray): [M], int64, rows above `thr`
+            keep (np.ndarray): [M], bool
+        """
+        N, L, S = conf.shape
+        row_max = np.empty((N, L), conf.dtype)
+        row_argmax = np.empty((N, L), np.int64)
+        for k in prange(N * L):
+            n, l = k // L, k % L
+            best, arg = conf[n, l, 0], 0
+            for s in range(1, S):
+                if conf[n, l, s] > best:
+                    best, arg = conf[n, l, s], s
+            row_max[n, l], row_argmax[n, l] = best, arg
+
+        # columns are reduced in chunks, so each thread keeps streaming over contiguous rows
+        chunk = 256
+        n_chunks = (S + chunk - 1) // chunk
+        col_max = np.empty((N, S), conf.dtype)
+        for k in prange(N * n_chunks):
+            n, s0 = k // n_chunks, k % n_chunks * chunk
+            s1 = min(s0 + chunk, S)
+            col_max[n, s0:s1] = conf[n, 0, s0:s1]
+            for l in range(1, L):
+                for s in range(s0, s1):
+                    if conf[n, l, s] > col_max[n, s]:
+                        col_max[n, s] = conf[n, l, s]
+
+        b_c, i_c = np.nonzero(row_max > thr)
+        keep = np.empty(len(b_c), np.bool_)
+        for k in prange(len(b_c)):
+            n, l = b_c[k], i_c[k]
+            keep[k] = row_max[n, l] == col_max[n, row_argmax[n, l]]
+        return row_max, row_argmax, b_c.astype(np.int64), i_c.astype(np.int64), keep
+else:
+    mutual_nearest_cpu = None
+
+
+def border_flags(h: int, w: int, bd: int, device: torch.device, h_valid=None, w_valid=None):
+    """Flag the cells of a flattened [h, w] grid lying within `bd` of its border
+
+    Args:
+        h_valid, w_valid: extent of the unpadded region, defaults to the full grid.
+            Pass [N, 1, 1] tensors to get the flags of N differently padded grids at once.
+    Returns:
+        flags (torch.Tensor): [h * w] or [N, h * w], bool
+    """
+    h_valid = h if h_valid is None else h_valid
+    w_valid = w if w_valid is None else w_valid
+    ys = torch.arange(h, device=device)[:, None]
+    xs = torch.arange(w, device=device)[None]
+    return ((ys < bd) | (ys >= h_valid - bd) | (xs < bd) | (xs >= w_valid - bd)).flatten(-2)
+
+
 class CoarseMatching(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -33,11 +231,23 @@ class CoarseMatching(nn.Module):
         # -- # for trainig fine-level LoFTR
         self.train_coarse_percent = config['train_coarse_percent']
         self.train_pad_num_gt_min = config['train_pad_num_gt_min']
+        self.numba_cpu = config['numba_cpu']
+        if self.numba_cpu and mutual_nearest_cpu is None:
+            raise ImportError("NUMBA_CPU needs numba, pip install numba first!")
+        # border flags only depend on the coarse resolution, cache them per shape
+        self._border_cache = {}
+        # [N, L, S] similarity buffer reused across inference calls
+        self._sim_buf = None
 
         # we provide 2 options for differentiable matching
         self.match_type = config['match_type']
         if self.match_type == 'dual_softmax':
             self.temperature = config['dsmax_temperature']
+            self.dsmax_bf16 = config['dsmax_bf16']
+            self.dsmax_compile = config['dsmax_compile']
+            if self.dsmax_compile and not hasattr(torch, 'compile'):
+                warnings.warn(f"DSMAX_COMPILE needs torch>=2.0 (found {torch.__version__}), "
+                              "falling back to TorchScript")
         elif self.match_type == 'sinkhorn':
             try:
                 from .superglue import log_optimal_transport
@@ -51,41 +261,49 @@ class CoarseMatching(nn.Module):
         else:
             raise NotImplementedError()
 
-    def mask_border_with_padding(self, m, bd: int, v: bool, p_m0, p_m1):
+    def train(self, mode: bool = True):
+        # don't keep an inference buffer (e.g. from validation) pinned during training
+        self._sim_buf = None
+        return super().train(mode)
+
+    def mask_border_with_padding(self, m, j_ids, bd: int, v: bool, hw0_c, hw1_c, hw0_valid, hw1_valid):
+        """ Mask borders of the unpadded regions with value
+        Args:
+            m (torch.Tensor): [N, L]
+            j_ids (torch.Tensor): [N, L], candidate match of each row
+            bd (int)
+            v (m.dtype)
+            hw0_c, hw1_c: coarse resolution of image0 and image1
+            hw0_valid, hw1_valid (torch.Tensor): [N, 2] unpadded extents, see `valid_hw`
+        """
         if bd <= 0:
             return
 
-        m[:, :bd] = v
-        m[:, :, :bd] = v
-        m[:, :, :, :bd] = v
-        m[:, :, :, :, :bd] = v
-
-        h0s, w0s = p_m0.sum(1).max(-1)[0].int(), p_m0.sum(-1).max(-1)[0].int()
-        h1s, w1s = p_m1.sum(1).max(-1)[0].int(), p_m1.sum(-1).max(-1)[0].int()
-        for b_idx, (h0, w0, h1, w1) in enumerate(zip(h0s, w0s, h1s, w1s)):
-            m[b_idx, h0 - bd:] = v
-            m[b_idx, :, w0 - bd:] = v
-            m[b_idx, :, :, h1 - bd:] = v
-            m[b_idx, :, :, :, w1 - bd:] = v
+        hw0_valid, hw1_valid = hw0_valid[:, :, None, None], hw1_valid[:, :, None, None]
+        border0 = border_flags(int(hw0_c[0]), int(hw0_c[1]), bd, m.device, hw0_valid[:, 0], hw0_valid[:, 1])
+        border1 = border_flags(int(hw1_c[0]), int(hw1_c[1]), bd, m.device, hw1_valid[:, 0], hw1_valid[:, 1])
+        m.masked_fill_(border0, v)
+        m.masked_fill_(border1.gather(1, j_ids), v)
 
-    def mask_border(self, m, b: int, v: bool):
+    def mask_border(self, m, j_ids, b: int, v: bool, hw0_c, hw1_c):
         """ Mask borders with value
         Args:
-            m (torch.Tensor): [N, H0, W0, H1, W1]
+            m (torch.Tensor): [N, L]
+            j_ids (torch.Tensor): [N, L], candidate match of each row
             b (int)
             v (m.dtype)
+            hw0_c, hw1_c: coarse resolution of image0 and image1
         """
         if b <= 0:
             return
 
-        m[:, :b] = v
-        m[:, :, :b] = v
-        m[:, :, :, :b] = v
-        m[:, :, :, :, :b] = v
-        m[:, -b:] = v
-        m[:, :, -b:] = v
-        m[:, :, :, -b:] = v
-        m[:, :, :, :, -b:] = v
+        key = (int(hw0_c[0]), int(hw0_c[1]), int(hw1_c[0]), int(hw1_c[1]), b, m.device)
+        if key not in self._border_cache:
+            self._border_cache[key] = (border_flags(key[0], key[1], b, m.device),
+                                       border_flags(key[2], key[3], b, m.device))
+        border0, border1 = self._border_cache[key]
+        m.masked_fill_(border0[None], v)
+        m.masked_fill_(border1[j_ids], v)
 
     def forward(self, feat_c0, feat_c1, data: Dict[str, torch.Tensor], mask_c0: Optional[torch.Tensor] = None,
                 mask_c1: Optional[torch.Tensor] = None):
@@ -98,6 +316,7 @@ class CoarseMatching(nn.Module):
             mask_c1 (torch.Tensor): [N, S] (optional)
         Update:
             data (dict): {
+                'conf_matrix' (torch.Tensor): [N, L, S], bf16 with DSMAX_BF16 at inference
                 'b_ids' (torch.Tensor): [M'],
                 'i_ids' (torch.Tensor): [M'],
                 'j_ids' (torch.Tensor): [M'],
@@ -106,23 +325,28 @@ class CoarseMatching(nn.Module):
                 'mkpts1_c' (torch.Tensor): [M, 2],
                 'mconf' (torch.Tensor): [M]}
             NOTE: M' != M during training.
+            NOTE: GeoFormer's 'dect_conf_matrix' is the first pass's conf_matrix, so it may be bf16 too.
         """
-        N, L, S, C = feat_c0.size(0), feat_c0.size(1), feat_c1.size(1), feat_c0.size(2)
-
-        # normalize
-        feat_c0, feat_c1 = feat_c0 / feat_c0.shape[-1] ** .5, feat_c1 / feat_c1.shape[-1] ** .5
-        # feat_c0, feat_c1 = map(lambda feat: feat / feat.shape[-1]**.5,
-        #                        [feat_c0, feat_c1])
-        INF = 1e9
-        # if self.match_type == 'dual_softmax':
-        sim_matrix = torch.einsum("nlc,nsc->nls", feat_c0,
-                                  feat_c1) / self.temperature
         if mask_c0 is not None:
-            assert mask_c0 is not None and mask_c1 is not None
-            # sim_matrix[~(mask_c0[..., None] * mask_c1[:, None])] = -torch.tensor(INF)
-            sim_matrix.masked_fill_(
-                ~(mask_c0[..., None] * mask_c1[:, None]), -INF)
-        conf_matrix = F.softmax(sim_matrix, 1) * F.softmax(sim_matrix, 2)
+            assert mask_c1 is not None
+        if self.dsmax_bf16 and feat_c0.is_cuda and not torch.is_grad_enabled():
+            # bmm accumulates and softmax reduces in fp32 internally, only the [N, L, S] storage
+            # drops to bf16, halving its memory traffic
+            feat_c0, feat_c1 = feat_c0.bfloat16(), feat_c1.bfloat16()
+        sim_buf = None
+        if not torch.is_grad_enabled():
+            # the similarity never leaves coarse_confidence, so its storage can be recycled.
+            # NOTE: conf_matrix is not, it is kept in data (e.g. GeoFormer's dect_conf_matrix)
+            shape = (feat_c0.size(0), feat_c0.size(1), feat_c1.size(1))
+            buf = self._sim_buf
+            if buf is None or buf.shape != shape or buf.dtype != feat_c0.dtype or buf.device != feat_c0.device:
+                # release the stale buffer first, so a shape change never holds two at once
+                self._sim_buf = buf = None
+                self._sim_buf = buf = feat_c0.new_empty(shape)
+            sim_buf = buf
+        # if self.match_type == 'dual_softmax':
+        conf_matrix = get_coarse_confidence(self.dsmax_compile)(feat_c0, feat_c1, mask_c0, mask_c1,
+                                                                self.temperature, sim_buf)
 
         data.update({'conf_matrix': conf_matrix})
 
@@ -146,46 +370,48 @@ class CoarseMatching(nn.Module):
                 'mkpts1_c' (torch.Tensor): [M, 2],
                 'mconf' (torch.Tensor): [M]}
         """
-        # axes_lengths = {
-        #     'h0c': data['hw0_c'][0],
-        #     'w0c': data['hw0_c'][1],
-        #     'h1c': data['hw1_c'][0],
-        #     'w1c': data['hw1_c'][1]
-        # }
-        h0c = data['hw0_c'][0]
         w0c = data['hw0_c'][1]
-        h1c = data['hw1_c'][0]
         w1c = data['hw1_c'][1]
         _device = conf_matrix.device
-        # 1. confidence thresholding
-        mask = conf_matrix > self.thr
-        b = mask.shape[0]
-        mask = mask.reshape(b, h0c, w0c, h1c, w1c)
-        # mask = rearrange(mask, 'b (h0c w0c) (h1c w1c) -> b h0c w0c h1c w1c',
-        #                  **axes_lengths)
-        if 'mask0' not in data:
-            self.mask_border(mask, self.border_rm, False)
+        # 1. mutual nearest with confidence thresholding, decided per row on [N, L] only:
+        # row i matches its argmax j iff its max is also the max of column j
+        if self.numba_cpu and _device.type == 'cpu':
+            row_max, all_j_ids, b_c, i_c, keep = map(
+                torch.from_numpy, mutual_nearest_cpu(conf_matrix.detach().numpy(), self.thr))
         else:
-            self.mask_border_with_padding(mask, self.border_rm, False,
-                                          data['mask0'], data['mask1'])
-        # mask = rearrange(mask, 'b h0c w0c h1c w1c -> b (h0c w0c) (h1c w1c)',
-        #                  **axes_lengths)
-        mask = mask.reshape(b, h0c * w0c, h1c * w1c)
+            row_max, all_j_ids, b_c, i_c, keep = mutual_nearest(conf_matrix, self.thr)
+        mask = None
+        if self.border_rm > 0 or 'dataset_name' in data:
+            # both of these work on the [N, L] mask
+            mask = torch.zeros_like(row_max, dtype=torch.bool)
+            mask[b_c, i_c] = keep
 
-        # 2. mutual nearest
-        mask = mask \
-               * (conf_matrix == conf_matrix.max(dim=2, keepdim=True)[0]) \
-               * (conf_matrix == conf_matrix.max(dim=1, keepdim=True)[0])
+        # 2. border removal, applied as [L] / [S] flags on the rows and their candidate matches
+        # border_rm is forced to 0 in __init__, skip the whole branch on the hot path
+        if self.border_rm > 0:
+            if 'mask0' not in data:
+                self.mask_border(mask, all_j_ids, self.border_rm, False, data['hw0_c'], data['hw1_c'])
+            else:
+                # constant for the pair, cache it for the second matching pass in GeoFormer
+                if '_hw0_valid' not in data:
+                    data.update({'_hw0_valid': valid_hw(data['mask0']),
+                                 '_hw1_valid': valid_hw(data['mask1'])})
+                self.mask_border_with_padding(mask, all_j_ids, self.border_rm, False, data['hw0_c'],
+                                              data['hw1_c'], data['_hw0_valid'], data['_hw1_valid'])
 
         # 3. find all valid coarse matches
-        # this only works when at most one `True` in each row
         if 'dataset_name' in data:
-            ck = mask.view(b, -1).sum(-1) == 0
-            mask[ck, 0, 0] = True
-        mask_v, all_j_ids = mask.max(dim=2)
-        b_ids, i_ids = torch.where(mask_v)
+            ck = ~mask.any(-1)
+            mask[ck, 0] = True
+            all_j_ids[ck, 0] = 0
+            row_max[ck, 0] = conf_matrix[ck, 0, 0]
+        if mask is None:
+            b_ids, i_ids = b_c[keep], i_c[keep]
+        else:
+            b_ids, i_ids = mask.nonzero(as_tuple=True)
         j_ids = all_j_ids[b_ids, i_ids]
-        mconf = conf_matrix[b_ids, i_ids, j_ids]
+        # row_max is bf16 with DSMAX_BF16, callers convert mconf to numpy
+        mconf = row_max[b_ids, i_ids].float()
 
         coarse_matches = {'b_ids': b_ids, 'i_ids': i_ids, 'j_ids': j_ids}
 
@@ -193,12 +419,11 @@ class CoarseMatching(nn.Module):
         scale = data['hw0_i'][0] / data['hw0_c'][0]
         scale0 = scale * data['scale0'][b_ids] if 'scale0' in data else scale
         scale1 = scale * data['scale1'][b_ids] if 'scale1' in data else scale
-        mkpts0_c = torch.stack(
-            [i_ids % data['hw0_c'][1], i_ids // data['hw0_c'][1]],
-            dim=1) * scale0
-        mkpts1_c = torch.stack(
-            [j_ids % data['hw1_c'][1], j_ids // data['hw1_c'][1]],
-            dim=1) * scale1
+        # one division per index, the remainder follows from it without a separate modulo
+        iy0 = torch.div(i_ids, w0c, rounding_mode='trunc')
+        iy1 = torch.div(j_ids, w1c, rounding_mode='trunc')
+        mkpts0_c = torch.stack([i_ids - iy0 * w0c, iy0], dim=1).to(scale0.dtype).mul_(scale0)
+        mkpts1_c = torch.stack([j_ids - iy1 * w1c, iy1], dim=1).to(scale1.dtype).mul_(scale1)
 
         # These matches is the current prediction (for visualization)
         coarse_matches.update({
@@ -33,11 +33,14 @@ _CN.MATCH_COARSE.THR = 0.4
 _CN.MATCH_COARSE.BORDER_RM = 2
 _CN.MATCH_COARSE.MATCH_TYPE = 'dual_softmax'  # options: ['dual_softmax, 'sinkhorn']
 _CN.MATCH_COARSE.DSMAX_TEMPERATURE = 0.1
+_CN.MATCH_COARSE.DSMAX_BF16 = False  # bf16 similarity / dual-softmax on CUDA (Ampere+), inference only
+_CN.MATCH_COARSE.DSMAX_COMPILE = False  # torch.compile the similarity / dual-softmax (torch>=2.0, TorchScript before)
 _CN.MATCH_COARSE.SKH_ITERS = 3
 _CN.MATCH_COARSE.SKH_INIT_BIN_SCORE = 1.0
 _CN.MATCH_COARSE.SKH_PREFILTER = True
 _CN.MATCH_COARSE.TRAIN_COARSE_PERCENT = 0.4  # training tricks: save GPU memory
 _CN.MATCH_COARSE.TRAIN_PAD_NUM_GT_MIN = 200  # training tricks: avoid DDP deadlock
+_CN.MATCH_COARSE.NUMBA_CPU = False  # numba mutual-nearest extraction for CPU inference (needs numba)
 
 # 4. LoFTR-fine module loftr_config
 _CN.FINE = CN()